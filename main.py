@@ -1,15 +1,24 @@
 import pygame
 import sys
 import os
-import socket
 import threading
-import json
-import time
+import socket
+import asyncio
+import queue
+import struct
+import random
+import functools
+import logging
+from collections import Counter, OrderedDict
 
 # Initialize pygame
 pygame.init()
 pygame.mixer.init()
 
+# Connection status goes to the console; errors are logged, not raised
+logging.basicConfig(level=logging.INFO, format='%(name)s: %(message)s')
+log = logging.getLogger('chess.net')
+
 # Screen dimensions
 WIDTH, HEIGHT = 640, 640
 screen = pygame.display.set_mode((WIDTH, HEIGHT))
@@ -34,11 +43,195 @@ INPUT_BORDER = (200, 200, 200)
 SQUARE_SIZE = WIDTH // 8
 PIECE_SIZE = SQUARE_SIZE - 10
 
+# Piece types and sides. WHITE and BLACK are taken by the RGB colors above.
+PAWN, ROOK, KNIGHT, BISHOP, QUEEN, KING = range(6)
+WHITE_SIDE, BLACK_SIDE = 0, 1
+SIDE_NAMES = ('white', 'black')
+PIECE_SYMBOLS = ('P', 'R', 'N', 'B', 'Q', 'K')
+# Castling rook (from col, to col), indexed by whether the king went kingside
+CASTLING_ROOK_COLS = ((0, 3), (7, 5))
+
+# Sliding piece directions as (row step, col step)
+ROOK_DIRS = ((0, 1), (1, 0), (0, -1), (-1, 0))
+BISHOP_DIRS = ((1, 1), (1, -1), (-1, 1), (-1, -1))
+QUEEN_DIRS = ROOK_DIRS + BISHOP_DIRS
+
+# Bitboards: bit (row * 8 + col) is set when the square at (row, col) is occupied
+FULL_BOARD = (1 << 64) - 1
+FILE_A = 0x0101010101010101
+FILE_H = FILE_A << 7
+NOT_FILE_A = FULL_BOARD ^ FILE_A
+NOT_FILE_H = FULL_BOARD ^ FILE_H
+NOT_FILE_AB = NOT_FILE_A & ~(FILE_A << 1)
+NOT_FILE_GH = NOT_FILE_H & ~(FILE_H >> 1)
+
+def _knight_attacks(b):
+    return (((b << 17) | (b >> 15)) & NOT_FILE_A |
+            ((b << 15) | (b >> 17)) & NOT_FILE_H |
+            ((b << 10) | (b >> 6)) & NOT_FILE_AB |
+            ((b << 6) | (b >> 10)) & NOT_FILE_GH) & FULL_BOARD
+
+def _king_attacks(b):
+    row = b | ((b << 1) & NOT_FILE_A) | ((b >> 1) & NOT_FILE_H)
+    return (row | (row << 8) | (row >> 8)) & FULL_BOARD ^ b
+
+KNIGHT_ATTACKS = [_knight_attacks(1 << sq) for sq in range(64)]
+KING_ATTACKS = [_king_attacks(1 << sq) for sq in range(64)]
+# Squares attacked by a pawn of the given color standing on sq
+PAWN_ATTACKS = (
+    [((1 << sq) >> 9) & NOT_FILE_H | ((1 << sq) >> 7) & NOT_FILE_A for sq in range(64)],
+    [(((1 << sq) << 7) & NOT_FILE_H | ((1 << sq) << 9) & NOT_FILE_A) & FULL_BOARD for sq in range(64)],
+)
+
+def _ray(sq, dr, dc):
+    mask = 0
+    r, c = divmod(sq, 8)
+    r, c = r + dr, c + dc
+    while 0 <= r < 8 and 0 <= c < 8:
+        mask |= 1 << (r * 8 + c)
+        r, c = r + dr, c + dc
+    return mask
+
+# Empty-board rays from every square, split by whether they run towards higher
+# or lower square indices so the nearest blocker is the lowest or highest bit
+RAYS = {(dr, dc): [_ray(sq, dr, dc) for sq in range(64)] for dr, dc in QUEEN_DIRS}
+ROOK_RAYS_INC = [RAYS[(0, 1)], RAYS[(1, 0)]]
+ROOK_RAYS_DEC = [RAYS[(0, -1)], RAYS[(-1, 0)]]
+BISHOP_RAYS_INC = [RAYS[(1, 1)], RAYS[(1, -1)]]
+BISHOP_RAYS_DEC = [RAYS[(-1, 1)], RAYS[(-1, -1)]]
+
+def _slider_attacks(sq, occ, rays_inc, rays_dec):
+    attacks = 0
+    for rays in rays_inc:
+        ray = rays[sq]
+        blockers = ray & occ
+        if blockers:
+            ray ^= rays[(blockers & -blockers).bit_length() - 1]
+        attacks |= ray
+    for rays in rays_dec:
+        ray = rays[sq]
+        blockers = ray & occ
+        if blockers:
+            ray ^= rays[blockers.bit_length() - 1]
+        attacks |= ray
+    return attacks
+
+def _blocker_mask(sq, rays_inc, rays_dec):
+    # Squares that can stop a slider on sq: its rays minus the far edge square,
+    # which is attacked whether or not anything stands on it
+    mask = 0
+    for rays in rays_inc:
+        ray = rays[sq]
+        if ray:
+            mask |= ray ^ (1 << (ray.bit_length() - 1))
+    for rays in rays_dec:
+        ray = rays[sq]
+        mask |= ray ^ (ray & -ray)
+    return mask
+
+ROOK_BLOCKERS = [_blocker_mask(sq, ROOK_RAYS_INC, ROOK_RAYS_DEC) for sq in range(64)]
+BISHOP_BLOCKERS = [_blocker_mask(sq, BISHOP_RAYS_INC, BISHOP_RAYS_DEC) for sq in range(64)]
+
+# Slider attacks per square, keyed by the occupancy of its blocker squares and
+# filled in on first use, so a repeat lookup is one mask and one dict hit
+ROOK_TABLE = [{} for _ in range(64)]
+BISHOP_TABLE = [{} for _ in range(64)]
+
+def rook_attacks(sq, occ):
+    occ &= ROOK_BLOCKERS[sq]
+    table = ROOK_TABLE[sq]
+    attacks = table.get(occ)
+    if attacks is None:
+        attacks = table[occ] = _slider_attacks(sq, occ, ROOK_RAYS_INC, ROOK_RAYS_DEC)
+    return attacks
+
+def bishop_attacks(sq, occ):
+    occ &= BISHOP_BLOCKERS[sq]
+    table = BISHOP_TABLE[sq]
+    attacks = table.get(occ)
+    if attacks is None:
+        attacks = table[occ] = _slider_attacks(sq, occ, BISHOP_RAYS_INC, BISHOP_RAYS_DEC)
+    return attacks
+
+def queen_attacks(sq, occ):
+    return rook_attacks(sq, occ) | bishop_attacks(sq, occ)
+
+# Zobrist keys: one random number per (square, piece), XORed together to give a
+# position hash that can be updated incrementally as pieces come and go.
+# Pieces are indexed color * 6 + piece_type, as in ChessGame.bb.
+ZOBRIST = [[random.getrandbits(64) for _ in range(12)] for _ in range(64)]
+ZOBRIST_SIDE = random.getrandbits(64)  # Black to move
+ZOBRIST_UNMOVED = [random.getrandbits(64) for _ in range(64)]  # Unmoved king/rook (castling rights)
+ZOBRIST_EN_PASSANT = [random.getrandbits(64) for _ in range(8)]  # En passant file
+MOVE_CACHE_SIZE = 50000
+
+def _between_table():
+    table = [[0] * 64 for _ in range(64)]
+    for sq in range(64):
+        r0, c0 = divmod(sq, 8)
+        for dr, dc in RAYS:
+            mask = 0
+            r, c = r0 + dr, c0 + dc
+            while 0 <= r < 8 and 0 <= c < 8:
+                table[sq][r * 8 + c] = mask
+                mask |= 1 << (r * 8 + c)
+                r, c = r + dr, c + dc
+    return table
+
+# BETWEEN[a][b]: squares strictly between a and b when they share a line, else 0
+BETWEEN = _between_table()
+
 # Font
 font = pygame.font.SysFont(None, 36)
 small_font = pygame.font.SysFont(None, 24)
 title_font = pygame.font.SysFont(None, 48)
 
+@functools.lru_cache(maxsize=128)
+def _render_text(text_font, text, color):
+    # Labels and status lines repeat frame after frame, so rasterize each once.
+    # Callers only blit the result, never draw on it.
+    return text_font.render(text, True, color)
+
+# Highlight squares, made once and blitted over the board every frame
+MOVE_SURF = pygame.Surface((SQUARE_SIZE, SQUARE_SIZE), pygame.SRCALPHA)
+MOVE_SURF.fill(MOVE_HIGHLIGHT)
+MOVE_SURF = MOVE_SURF.convert_alpha()
+CHECK_SURF = pygame.Surface((SQUARE_SIZE, SQUARE_SIZE), pygame.SRCALPHA)
+CHECK_SURF.fill(CHECK_HIGHLIGHT)
+CHECK_SURF = CHECK_SURF.convert_alpha()
+SELECTED_SURF = pygame.Surface((SQUARE_SIZE, SQUARE_SIZE))
+SELECTED_SURF.fill(SELECTED_SQUARE)
+
+def _render_piece_sprite(color, piece_type):
+    sprite = pygame.Surface((SQUARE_SIZE, SQUARE_SIZE), pygame.SRCALPHA)
+    center = (SQUARE_SIZE // 2, SQUARE_SIZE // 2)
+    
+    # Draw piece background circle
+    pygame.draw.circle(sprite, (200, 200, 200) if color == WHITE_SIDE else (50, 50, 50),
+                       center, PIECE_SIZE // 2)
+    pygame.draw.circle(sprite, (0, 0, 0) if color == WHITE_SIDE else (255, 255, 255),
+                       center, PIECE_SIZE // 2, 2)
+    
+    # Draw piece symbol
+    text = font.render(PIECE_SYMBOLS[piece_type], True, (255, 255, 255) if color == WHITE_SIDE else (0, 0, 0))
+    sprite.blit(text, text.get_rect(center=center))
+    # In the display's pixel format, so blitting it needs no conversion
+    return sprite.convert_alpha()
+
+# One square-sized sprite per piece kind, rendered once and indexed
+# color * 6 + piece_type like the bitboards
+PIECE_SPRITES = [_render_piece_sprite(color, piece_type)
+                 for color in (WHITE_SIDE, BLACK_SIDE) for piece_type in range(6)]
+
+# Top-left pixel of every board square, indexed row * 8 + col, for the
+# normal and the rotated view
+SQUARE_ORIGINS = (
+    [(col * SQUARE_SIZE, row * SQUARE_SIZE) for row in range(8) for col in range(8)],
+    [((7 - col) * SQUARE_SIZE, (7 - row) * SQUARE_SIZE) for row in range(8) for col in range(8)],
+)
+SQUARE_COLORS = [LIGHT_SQUARE if (row + col) % 2 == 0 else DARK_SQUARE
+                 for row in range(8) for col in range(8)]
+
 def resource_path(relative_path):
     try:
         base_path = sys._MEIPASS
@@ -46,51 +239,60 @@ def resource_path(relative_path):
         base_path = os.path.abspath(".")
     return os.path.join(base_path, relative_path)
 
+# Events posted by the network thread
+NETWORK_MOVE_EVENT = pygame.USEREVENT + 1
+CONNECTION_LOST_EVENT = pygame.USEREVENT + 2
+
+# Network messages are fixed-size packets: kind, from square, to square,
+# promotion piece, flags. A side assignment carries the color in the from byte.
+MOVE_STRUCT = struct.Struct('<BBBBB')
+READ_SIZE = MOVE_STRUCT.size * 64  # Most bytes (64 packets) taken per StreamReader.read call
+KIND_MOVE = 0
+KIND_SIDE = 1
+# Kinds 2 (resign) and 3 (draw offer) are reserved
+FLAG_CASTLING = 1
+FLAG_EN_PASSANT = 2
+PROMOTION_TYPES = (None, QUEEN, ROOK, BISHOP, KNIGHT)
+PROMOTION_CODES = {piece_type: code for code, piece_type in enumerate(PROMOTION_TYPES)}
+
+def pack_message(move_data):
+    if move_data.get('type') == 'side':
+        return MOVE_STRUCT.pack(KIND_SIDE, move_data['side'], 0, 0, 0)
+    (from_row, from_col), (to_row, to_col) = move_data['from'], move_data['to']
+    flags = ((FLAG_CASTLING if move_data.get('castling') else 0) |
+             (FLAG_EN_PASSANT if move_data.get('en_passant') else 0))
+    return MOVE_STRUCT.pack(KIND_MOVE, from_row * 8 + from_col, to_row * 8 + to_col,
+                            PROMOTION_CODES[move_data.get('promotion')], flags)
+
+def unpack_message(data):
+    kind, from_sq, to_sq, promo, flags = MOVE_STRUCT.unpack(data)
+    if kind == KIND_SIDE and from_sq in (WHITE_SIDE, BLACK_SIDE):
+        return {'type': 'side', 'side': from_sq}
+    if kind != KIND_MOVE or from_sq > 63 or to_sq > 63 or promo >= len(PROMOTION_TYPES):
+        raise ValueError(f"Malformed move packet {data.hex()}")
+    return {'from': divmod(from_sq, 8), 'to': divmod(to_sq, 8),
+            'castling': bool(flags & FLAG_CASTLING),
+            'en_passant': bool(flags & FLAG_EN_PASSANT),
+            'promotion': PROMOTION_TYPES[promo]}
+
 # Load sound (if available)
 move_sound = None
 
 class Piece:
     def __init__(self, color, piece_type, row, col):
-        self.color = color  # 'white' or 'black'
-        self.piece_type = piece_type  # 'pawn', 'rook', 'knight', 'bishop', 'queen', 'king'
+        self.color = color  # WHITE_SIDE or BLACK_SIDE
+        self.piece_type = piece_type  # PAWN, ROOK, KNIGHT, BISHOP, QUEEN or KING
         self.row = row
         self.col = col
         self.has_moved = False
     
     def get_symbol(self):
-        symbols = {
-            'king': 'K',
-            'queen': 'Q',
-            'rook': 'R',
-            'bishop': 'B',
-            'knight': 'N',
-            'pawn': 'P'
-        }
-        return symbols[self.piece_type]
+        return PIECE_SYMBOLS[self.piece_type]
     
     def draw(self, screen, rotated=False):
-        # Create text surface for the piece
-        color = (255, 255, 255) if self.color == 'white' else (0, 0, 0)
-        symbol = self.get_symbol()
-        
-        # Calculate position based on rotation
-        if rotated:
-            center_x = (7 - self.col) * SQUARE_SIZE + SQUARE_SIZE // 2
-            center_y = (7 - self.row) * SQUARE_SIZE + SQUARE_SIZE // 2
-        else:
-            center_x = self.col * SQUARE_SIZE + SQUARE_SIZE // 2
-            center_y = self.row * SQUARE_SIZE + SQUARE_SIZE // 2
-        
-        # Draw piece background circle
-        pygame.draw.circle(screen, (200, 200, 200) if self.color == 'white' else (50, 50, 50), 
-                          (center_x, center_y), PIECE_SIZE // 2)
-        pygame.draw.circle(screen, (0, 0, 0) if self.color == 'white' else (255, 255, 255), 
-                          (center_x, center_y), PIECE_SIZE // 2, 2)
-        
-        # Draw piece symbol
-        text = font.render(symbol, True, color)
-        text_rect = text.get_rect(center=(center_x, center_y))
-        screen.blit(text, text_rect)
+        # A promoted pawn just picks up its new sprite
+        screen.blit(PIECE_SPRITES[self.color * 6 + self.piece_type],
+                    SQUARE_ORIGINS[rotated][self.row * 8 + self.col])
 
 class Button:
     def __init__(self, x, y, width, height, text, color=BUTTON_COLOR):
@@ -105,13 +307,15 @@ class Button:
         pygame.draw.rect(screen, color, self.rect, border_radius=10)
         pygame.draw.rect(screen, WHITE, self.rect, 2, border_radius=10)
         
-        text_surf = font.render(self.text, True, WHITE)
+        text_surf = _render_text(font, self.text, WHITE)
         text_rect = text_surf.get_rect(center=self.rect.center)
         screen.blit(text_surf, text_rect)
     
     def check_hover(self, pos):
-        self.is_hovered = self.rect.collidepoint(pos)
-        return self.is_hovered
+        # Returns whether the hover state changed, i.e. the button needs redrawing
+        was_hovered = self.is_hovered
+        self.is_hovered = bool(self.rect.collidepoint(pos))
+        return self.is_hovered != was_hovered
     
     def is_clicked(self, pos, event):
         if event.type == pygame.MOUSEBUTTONDOWN and event.button == 1:
@@ -123,7 +327,8 @@ class InputBox:
         self.rect = pygame.Rect(x, y, w, h)
         self.color = INPUT_BORDER
         self.text = text
-        self.txt_surface = font.render(text, True, BLACK)
+        self.txt_surface = None
+        self._dirty = True  # Text needs rendering before the next draw
         self.active = False
 
     def handle_event(self, event):
@@ -143,159 +348,473 @@ class InputBox:
                     self.color = INPUT_BORDER
                 elif event.key == pygame.K_BACKSPACE:
                     self.text = self.text[:-1]
-                else:
-                    self.text += event.unicode
-                # Re-render the text
-                self.txt_surface = font.render(self.text, True, BLACK)
+                    # Re-render the text on the next frame, however many keys arrive before it
+                    self._dirty = True
+
+    def apply_text(self, text):
+        # Typed characters come in as TEXTINPUT events; rendering waits for the next draw
+        if self.active and text:
+            self.text += text
+            self._dirty = True
 
     def update(self):
-        # Resize the box if the text is too long
-        width = max(200, self.txt_surface.get_width()+10)
-        self.rect.w = width
+        # Nothing to do until the text changes
+        if self._dirty:
+            self.txt_surface = font.render(self.text, True, BLACK)
+            self._dirty = False
+            # Resize the box if the text is too long
+            width = max(200, self.txt_surface.get_width()+10)
+            self.rect.w = width
 
     def draw(self, screen):
+        self.update()
         # Draw the input box
         pygame.draw.rect(screen, INPUT_BG, self.rect, border_radius=5)
         pygame.draw.rect(screen, self.color, self.rect, 2, border_radius=5)
         screen.blit(self.txt_surface, (self.rect.x+5, self.rect.y+5))
 
+class NetworkClient:
+    """Game connection driven by an asyncio loop on a background thread.
+    
+    Messages travel as MOVE_STRUCT packets. Received messages are put on `incoming`
+    and announced with a NETWORK_MOVE_EVENT so the main loop wakes up to apply
+    them; a CONNECTION_LOST_EVENT is posted if the peer goes away.
+    """
+    
+    def __init__(self):
+        self.incoming = queue.SimpleQueue()
+        self._loop = asyncio.new_event_loop()
+        self._outgoing = None
+        self._server = None
+        self._session = None
+        self._closing = False
+        threading.Thread(target=self._run_loop, daemon=True).start()
+    
+    def serve(self, host, port):
+        """Wait for an opponent to connect and return their address"""
+        return self._run(self._serve(host, port))
+    
+    def connect(self, host, port):
+        self._run(self._connect(host, port))
+    
+    def send(self, move_data):
+        self._loop.call_soon_threadsafe(self._outgoing.put_nowait, move_data)
+    
+    def close(self):
+        self._closing = True
+        asyncio.run_coroutine_threadsafe(self._shutdown(), self._loop)
+    
+    def _run_loop(self):
+        self._loop.run_forever()
+        self._loop.close()
+    
+    def _run(self, coro):
+        # Block the calling thread until the coroutine finishes on the loop
+        return asyncio.run_coroutine_threadsafe(coro, self._loop).result()
+    
+    async def _serve(self, host, port):
+        connected = self._loop.create_future()
+        
+        def on_connect(reader, writer):
+            if connected.done():
+                writer.close()
+            else:
+                connected.set_result((reader, writer))
+        
+        self._server = await asyncio.start_server(on_connect, host, port, reuse_address=True)
+        log.info("Server listening on port %s", port)
+        reader, writer = await connected
+        self._server.close()
+        self._start_session(reader, writer)
+        return writer.get_extra_info('peername')
+    
+    async def _connect(self, host, port):
+        reader, writer = await asyncio.open_connection(host, port)
+        self._start_session(reader, writer)
+    
+    def _start_session(self, reader, writer):
+        sock = writer.get_extra_info('socket')
+        if sock is not None:
+            # Moves are a few bytes each, so send them without waiting for more
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            # Probe an idle link so a peer that vanished without closing it is
+            # noticed within a couple of minutes rather than hours
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            if hasattr(socket, 'TCP_KEEPIDLE'):
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, 60)
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, 10)
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 5)
+        self._outgoing = asyncio.Queue()
+        self._session = self._loop.create_task(self._run_session(reader, writer))
+    
+    async def _run_session(self, reader, writer):
+        tasks = [self._loop.create_task(self._reader(reader)),
+                 self._loop.create_task(self._writer(writer))]
+        try:
+            await asyncio.gather(*tasks)
+        except (OSError, asyncio.IncompleteReadError, ValueError) as e:
+            if not self._closing:
+                log.warning("Receive error: %s", e)
+        finally:
+            for task in tasks:
+                task.cancel()
+            writer.close()
+            if not self._closing:
+                pygame.event.post(pygame.event.Event(CONNECTION_LOST_EVENT))
+    
+    async def _reader(self, reader):
+        size = MOVE_STRUCT.size
+        while True:
+            # Take everything the stream has buffered (up to READ_SIZE) in one
+            # go, topped up to a packet boundary, and announce it with a single event
+            data = await reader.read(READ_SIZE)
+            if not data:
+                raise asyncio.IncompleteReadError(data, size)
+            partial = len(data) % size
+            if partial:
+                data += await reader.readexactly(size - partial)
+            view = memoryview(data)
+            for offset in range(0, len(data), size):
+                self.incoming.put(unpack_message(view[offset:offset + size]))
+            pygame.event.post(pygame.event.Event(NETWORK_MOVE_EVENT))
+    
+    async def _writer(self, writer):
+        while True:
+            # Anything else queued by then goes out in the same write
+            data = pack_message(await self._outgoing.get())
+            while not self._outgoing.empty():
+                data += pack_message(self._outgoing.get_nowait())
+            writer.write(data)
+            await writer.drain()
+    
+    async def _shutdown(self):
+        if self._server:
+            self._server.close()
+        if self._session:
+            # Let the cancelled session close its writer before stopping
+            self._session.cancel()
+            await asyncio.gather(self._session, return_exceptions=True)
+        await self._loop.shutdown_default_executor()
+        self._loop.stop()
+
+# Pseudo-legal move generators, one per piece type. Each returns a bitboard of
+# target squares; ChessGame.get_valid_moves drops those that leave the king in check.
+def _pawn_moves(game, piece):
+    moves = 0
+    row, col = piece.row, piece.col
+    direction = -1 if piece.color == WHITE_SIDE else 1
+    
+    # Move forward
+    if 0 <= row + direction < 8 and not game.board[(row + direction) * 8 + col]:
+        moves |= 1 << ((row + direction) * 8 + col)
+        
+        # Initial double move
+        if not piece.has_moved:
+            if 0 <= row + 2 * direction < 8 and not game.board[(row + 2 * direction) * 8 + col]:
+                moves |= 1 << ((row + 2 * direction) * 8 + col)
+    
+    # Capture diagonally (not horizontally or vertically)
+    for dc in (-1, 1):
+        if 0 <= row + direction < 8 and 0 <= col + dc < 8:
+            target = game.board[(row + direction) * 8 + col + dc]
+            # Normal capture
+            if target and target.color != piece.color:
+                moves |= 1 << ((row + direction) * 8 + col + dc)
+            # En passant capture
+            elif (game.en_passant_target != None and 
+                  row + direction == game.en_passant_target[0] and 
+                  col + dc == game.en_passant_target[1]):
+                moves |= 1 << ((row + direction) * 8 + col + dc)
+    return moves
+
+def _knight_moves(game, piece):
+    # L-shaped moves onto any square not holding a friendly piece
+    own = game.occ[piece.color]
+    return KNIGHT_ATTACKS[piece.row * 8 + piece.col] & ~own
+
+def _slider(attacks):
+    # Rooks, bishops and queens: every square the piece attacks along its
+    # lines, up to and including the first blocker unless that is friendly
+    def slider_moves(game, piece):
+        return attacks(piece.row * 8 + piece.col, game.occ_all) & ~game.occ[piece.color]
+    return slider_moves
+
+def _king_moves(game, piece):
+    # One square in any direction
+    row, col = piece.row, piece.col
+    own = game.occ[piece.color]
+    moves = KING_ATTACKS[row * 8 + col] & ~own
+    
+    # Castling: one attack map answers both "in check?" and whether
+    # the squares the king passes over are safe
+    if not piece.has_moved:
+        attacked = game.attacked_squares(piece.color)
+        if not attacked & (1 << (row * 8 + col)):
+            board = game.board
+            base = row * 8
+            # Kingside castling
+            if (board[base + 7] and 
+                board[base + 7].piece_type == ROOK and 
+                not board[base + 7].has_moved and
+                not board[base + 5] and 
+                not board[base + 6]):
+                # Check if squares are not under attack
+                if not attacked & ((1 << (row * 8 + 5)) | (1 << (row * 8 + 6))):
+                    moves |= 1 << (row * 8 + 6)  # Kingside castling
+            
+            # Queenside castling
+            if (board[base] and 
+                board[base].piece_type == ROOK and 
+                not board[base].has_moved and
+                not board[base + 1] and 
+                not board[base + 2] and 
+                not board[base + 3]):
+                # Check if squares are not under attack
+                if not attacked & ((1 << (row * 8 + 3)) | (1 << (row * 8 + 2))):
+                    moves |= 1 << (row * 8 + 2)  # Queenside castling
+    return moves
+
+# Indexed by piece type
+MOVEGEN = [
+    _pawn_moves,
+    _slider(rook_attacks),
+    _knight_moves,
+    _slider(bishop_attacks),
+    _slider(queen_attacks),
+    _king_moves,
+]
+
 class ChessGame:
     def __init__(self):
-        self.board = [[None for _ in range(8)] for _ in range(8)]
-        self.current_player = 'white'
+        self.board = [None] * 64  # Indexed row * 8 + col
+        self.current_player = WHITE_SIDE
         self.selected_piece = None
-        self.valid_moves = []
+        self.valid_moves = 0  # Bitboard of target squares for the selected piece
         self.game_over = False
         self.winner = None
         self.check = False
         self.checkmate = False
         self.stalemate = False
+        self.repetition = False  # Draw by threefold repetition
         self.move_history = []
         self.en_passant_target = None  # Position where en passant is possible
-        self.player_side = None  # 'white', 'black', or None for local play
+        self.player_side = None  # WHITE_SIDE, BLACK_SIDE, or None for local play
         self.game_mode = 'menu'  # 'menu', 'setup', 'playing', 'game_over'
         self.network_mode = None  # 'server', 'client', or None
-        self.server_socket = None
-        self.client_socket = None
-        self.connection = None
+        self.net = None  # NetworkClient while playing online
         self.is_my_turn = False
         self.view_rotated = False  # For black player view
+        self._square_origins = SQUARE_ORIGINS[False]
         self.move_count = 0  # Track total moves
+        # One bitboard per piece, indexed color * 6 + piece_type, plus occupancy masks
+        self.bb = [0] * 12
+        self.occ = [0, 0]  # Indexed by color
+        self.occ_all = 0
+        self.king_pos = [None, None]
+        self.pieces_by_color = ([], [])
+        self.zkey = 0  # Zobrist hash of the current position
+        self.position_counts = Counter()  # _repetition_key() -> times the position has occurred
+        self._move_cache = OrderedDict()  # zkey -> {(row, col): valid moves}
+        self._any_legal_cache = OrderedDict()  # (zkey, color) -> has a legal move
+        self._check_cache = {}  # (zkey, color) -> in check, for the position after the last move
+        self._legal_for_side = {}  # Piece -> valid moves, for the side to move this turn
+        self._legality_key = None  # (zkey, color) that _pins and _check_mask describe
+        self._pins = {}  # Pinned piece -> direction from its king to the pinner
+        self._check_mask = None  # Squares that answer a check, None when not in check
+        self._king_sq = None
         self.initialize_board()
+        self.position_counts[self._repetition_key()] += 1
+        self._render_board_surfaces()
     
     def initialize_board(self):
         # Set up pawns
         for col in range(8):
-            self.board[1][col] = Piece('black', 'pawn', 1, col)
-            self.board[6][col] = Piece('white', 'pawn', 6, col)
+            self._put(Piece(BLACK_SIDE, PAWN, 1, col), 1, col)
+            self._put(Piece(WHITE_SIDE, PAWN, 6, col), 6, col)
         
         # Set up other pieces
         # Black pieces (top)
-        self.board[0][0] = Piece('black', 'rook', 0, 0)
-        self.board[0][1] = Piece('black', 'knight', 0, 1)
-        self.board[0][2] = Piece('black', 'bishop', 0, 2)
-        self.board[0][3] = Piece('black', 'queen', 0, 3)
-        self.board[0][4] = Piece('black', 'king', 0, 4)
-        self.board[0][5] = Piece('black', 'bishop', 0, 5)
-        self.board[0][6] = Piece('black', 'knight', 0, 6)
-        self.board[0][7] = Piece('black', 'rook', 0, 7)
+        self._put(Piece(BLACK_SIDE, ROOK, 0, 0), 0, 0)
+        self._put(Piece(BLACK_SIDE, KNIGHT, 0, 1), 0, 1)
+        self._put(Piece(BLACK_SIDE, BISHOP, 0, 2), 0, 2)
+        self._put(Piece(BLACK_SIDE, QUEEN, 0, 3), 0, 3)
+        self._put(Piece(BLACK_SIDE, KING, 0, 4), 0, 4)
+        self._put(Piece(BLACK_SIDE, BISHOP, 0, 5), 0, 5)
+        self._put(Piece(BLACK_SIDE, KNIGHT, 0, 6), 0, 6)
+        self._put(Piece(BLACK_SIDE, ROOK, 0, 7), 0, 7)
         
         # White pieces (bottom)
-        self.board[7][0] = Piece('white', 'rook', 7, 0)
-        self.board[7][1] = Piece('white', 'knight', 7, 1)
-        self.board[7][2] = Piece('white', 'bishop', 7, 2)
-        self.board[7][3] = Piece('white', 'queen', 7, 3)
-        self.board[7][4] = Piece('white', 'king', 7, 4)
-        self.board[7][5] = Piece('white', 'bishop', 7, 5)
-        self.board[7][6] = Piece('white', 'knight', 7, 6)
-        self.board[7][7] = Piece('white', 'rook', 7, 7)
+        self._put(Piece(WHITE_SIDE, ROOK, 7, 0), 7, 0)
+        self._put(Piece(WHITE_SIDE, KNIGHT, 7, 1), 7, 1)
+        self._put(Piece(WHITE_SIDE, BISHOP, 7, 2), 7, 2)
+        self._put(Piece(WHITE_SIDE, QUEEN, 7, 3), 7, 3)
+        self._put(Piece(WHITE_SIDE, KING, 7, 4), 7, 4)
+        self._put(Piece(WHITE_SIDE, BISHOP, 7, 5), 7, 5)
+        self._put(Piece(WHITE_SIDE, KNIGHT, 7, 6), 7, 6)
+        self._put(Piece(WHITE_SIDE, ROOK, 7, 7), 7, 7)
+        
+        for piece in self.board:
+            if piece:
+                self.pieces_by_color[piece.color].append(piece)
     
-    def draw_board(self, screen):
-        # Draw squares
-        for row in range(8):
-            for col in range(8):
-                # Calculate position based on rotation
-                if self.view_rotated:
-                    draw_row = 7 - row
-                    draw_col = 7 - col
+    def _toggle(self, piece, row, col):
+        sq = row * 8 + col
+        bit = 1 << sq
+        index = piece.color * 6 + piece.piece_type
+        self.bb[index] ^= bit
+        self.zkey ^= ZOBRIST[sq][index]
+        if not piece.has_moved and piece.piece_type in (KING, ROOK):
+            self.zkey ^= ZOBRIST_UNMOVED[sq]
+        self.occ[piece.color] ^= bit
+        self.occ_all ^= bit
+    
+    def _put(self, piece, row, col):
+        """Place a piece on an empty square, keeping the bitboards in sync"""
+        self.board[row * 8 + col] = piece
+        piece.row, piece.col = row, col
+        self._toggle(piece, row, col)
+        if piece.piece_type == KING:
+            self.king_pos[piece.color] = (row, col)
+    
+    def _lift(self, row, col):
+        """Take whatever piece stands on a square off the board and return it"""
+        piece = self.board[row * 8 + col]
+        if piece:
+            self.board[row * 8 + col] = None
+            self._toggle(piece, row, col)
+        return piece
+    
+    def _set_en_passant_target(self, target):
+        if self.en_passant_target:
+            self.zkey ^= ZOBRIST_EN_PASSANT[self.en_passant_target[1]]
+        self.en_passant_target = target
+        if target:
+            self.zkey ^= ZOBRIST_EN_PASSANT[target[1]]
+    
+    def _switch_player(self):
+        self.current_player ^= 1
+        self.zkey ^= ZOBRIST_SIDE
+    
+    def _start_turn(self):
+        # The check, checkmate and stalemate tests and the next piece selected all
+        # need the side to move's legal moves, so generate them once up front;
+        # they also land in _move_cache, where _has_any_legal_move finds them
+        self._check_cache.clear()
+        self._legal_for_side = {piece: self.get_valid_moves(piece)
+                                for piece in self.pieces_by_color[self.current_player]}
+    
+    def _repetition_key(self):
+        # zkey also tells apart positions whose only difference is a right
+        # nobody can use, which is right for caching moves but not for
+        # repetition: drop the en passant file unless a pawn can really take,
+        # and the unmoved keys of a king and rooks that can no longer castle
+        key = self.zkey
+        target = self.en_passant_target
+        if target:
+            target_bit = 1 << (target[0] * 8 + target[1])
+            pawns = PAWN_ATTACKS[self.current_player ^ 1][target[0] * 8 + target[1]] & \
+                    self.bb[self.current_player * 6 + PAWN]
+            can_take = False
+            while pawns and not can_take:
+                bit = pawns & -pawns
+                pawns ^= bit
+                pawn = self.board[bit.bit_length() - 1]
+                moves = self._legal_for_side.get(pawn)
+                can_take = bool((self.get_valid_moves(pawn) if moves is None else moves) & target_bit)
+            if not can_take:
+                key ^= ZOBRIST_EN_PASSANT[target[1]]
+        
+        for color, row in ((WHITE_SIDE, 7), (BLACK_SIDE, 0)):
+            king = self.board[row * 8 + 4]
+            king_unmoved = bool(king and king.piece_type == KING and king.color == color and not king.has_moved)
+            can_castle = False
+            for sq in (row * 8, row * 8 + 7):
+                rook = self.board[sq]
+                if rook and rook.piece_type == ROOK and rook.color == color and not rook.has_moved:
+                    if king_unmoved:
+                        can_castle = True
+                    else:
+                        key ^= ZOBRIST_UNMOVED[sq]
+            if king_unmoved and not can_castle:
+                key ^= ZOBRIST_UNMOVED[row * 8 + 4]
+        return key
+    
+    def _render_board_surfaces(self):
+        # Empty board: the square colors don't change with rotation
+        self._empty_board_surf = pygame.Surface((WIDTH, HEIGHT))
+        for (x, y), color in zip(SQUARE_ORIGINS[False], SQUARE_COLORS):
+            pygame.draw.rect(self._empty_board_surf, color, (x, y, SQUARE_SIZE, SQUARE_SIZE))
+        
+        # Coordinates are drawn over everything else, so they get their own layer
+        self._coords_surfs = {}
+        for rotated in (False, True):
+            surf = pygame.Surface((WIDTH, HEIGHT), pygame.SRCALPHA)
+            for i in range(8):
+                # Numbers and letters based on rotation
+                if rotated:
+                    # Numbers on the right
+                    text = small_font.render(str(i+1), True, TEXT_COLOR)
+                    surf.blit(text, (WIDTH - 20, (7 - i) * SQUARE_SIZE + 5))
+                    # Letters on the top
+                    text = small_font.render(chr(104-i), True, TEXT_COLOR)
+                    surf.blit(text, ((7 - i) * SQUARE_SIZE + 5, 5))
                 else:
-                    draw_row = row
-                    draw_col = col
-                
-                color = LIGHT_SQUARE if (row + col) % 2 == 0 else DARK_SQUARE
-                pygame.draw.rect(screen, color, (draw_col * SQUARE_SIZE, draw_row * SQUARE_SIZE, SQUARE_SIZE, SQUARE_SIZE))
+                    # Numbers on the left
+                    text = small_font.render(str(8-i), True, TEXT_COLOR)
+                    surf.blit(text, (5, i * SQUARE_SIZE + 5))
+                    # Letters on the bottom
+                    text = small_font.render(chr(97+i), True, TEXT_COLOR)
+                    surf.blit(text, (i * SQUARE_SIZE + SQUARE_SIZE - 15, HEIGHT - 20))
+            self._coords_surfs[rotated] = surf
+        
+        # Board plus pieces, recomposed only when the position or view changes
+        self._board_cache_surf = pygame.Surface((WIDTH, HEIGHT))
+        self._board_cache_key = None
+    
+    def _set_view_rotated(self, rotated):
+        # The view is fixed once a game starts, so pick the square mapping here
+        # instead of testing the flag for every square drawn
+        self.view_rotated = rotated
+        self._square_origins = SQUARE_ORIGINS[rotated]
+    
+    def _draw_overlay(self, screen, overlay, sq):
+        # Highlights sit between the square and its piece, so put the piece back on top
+        origin = self._square_origins[sq]
+        screen.blit(overlay, origin)
+        piece = self.board[sq]
+        if piece:
+            screen.blit(PIECE_SPRITES[piece.color * 6 + piece.piece_type], origin)
+    
+    def draw_board(self, screen):
+        # Squares and pieces
+        cache_key = (self.zkey, self.view_rotated)
+        if self._board_cache_key != cache_key:
+            self._board_cache_surf.blit(self._empty_board_surf, (0, 0))
+            for piece, origin in zip(self.board, self._square_origins):
+                if piece:
+                    self._board_cache_surf.blit(PIECE_SPRITES[piece.color * 6 + piece.piece_type], origin)
+            self._board_cache_key = cache_key
+        screen.blit(self._board_cache_surf, (0, 0))
         
         # Highlight selected square
         if self.selected_piece:
-            # Calculate position based on rotation
-            if self.view_rotated:
-                draw_row = 7 - self.selected_piece.row
-                draw_col = 7 - self.selected_piece.col
-            else:
-                draw_row = self.selected_piece.row
-                draw_col = self.selected_piece.col
-            
-            pygame.draw.rect(screen, SELECTED_SQUARE, 
-                            (draw_col * SQUARE_SIZE, 
-                             draw_row * SQUARE_SIZE, 
-                             SQUARE_SIZE, SQUARE_SIZE))
+            self._draw_overlay(screen, SELECTED_SURF, self.selected_piece.row * 8 + self.selected_piece.col)
         
         # Highlight valid moves
-        for move in self.valid_moves:
-            row, col = move
-            # Calculate position based on rotation
-            if self.view_rotated:
-                draw_row = 7 - row
-                draw_col = 7 - col
-            else:
-                draw_row = row
-                draw_col = col
-            
-            s = pygame.Surface((SQUARE_SIZE, SQUARE_SIZE), pygame.SRCALPHA)
-            s.fill(MOVE_HIGHLIGHT)
-            screen.blit(s, (draw_col * SQUARE_SIZE, draw_row * SQUARE_SIZE))
+        moves = self.valid_moves
+        while moves:
+            bit = moves & -moves
+            moves ^= bit
+            self._draw_overlay(screen, MOVE_SURF, bit.bit_length() - 1)
         
         # Highlight king in check
         if self.check:
             king_pos = self.find_king(self.current_player)
             if king_pos:
-                row, col = king_pos
-                # Calculate position based on rotation
-                if self.view_rotated:
-                    draw_row = 7 - row
-                    draw_col = 7 - col
-                else:
-                    draw_row = row
-                    draw_col = col
-                
-                s = pygame.Surface((SQUARE_SIZE, SQUARE_SIZE), pygame.SRCALPHA)
-                s.fill(CHECK_HIGHLIGHT)
-                screen.blit(s, (draw_col * SQUARE_SIZE, draw_row * SQUARE_SIZE))
-        
-        # Draw pieces
-        for row in range(8):
-            for col in range(8):
-                piece = self.board[row][col]
-                if piece:
-                    piece.draw(screen, self.view_rotated)
+                self._draw_overlay(screen, CHECK_SURF, king_pos[0] * 8 + king_pos[1])
         
         # Draw coordinates
-        for i in range(8):
-            # Numbers and letters based on rotation
-            if self.view_rotated:
-                # Numbers on the right
-                text = small_font.render(str(i+1), True, TEXT_COLOR)
-                screen.blit(text, (WIDTH - 20, (7 - i) * SQUARE_SIZE + 5))
-                # Letters on the top
-                text = small_font.render(chr(104-i), True, TEXT_COLOR)
-                screen.blit(text, ((7 - i) * SQUARE_SIZE + 5, 5))
-            else:
-                # Numbers on the left
-                text = small_font.render(str(8-i), True, TEXT_COLOR)
-                screen.blit(text, (5, i * SQUARE_SIZE + 5))
-                # Letters on the bottom
-                text = small_font.render(chr(97+i), True, TEXT_COLOR)
-                screen.blit(text, (i * SQUARE_SIZE + SQUARE_SIZE - 15, HEIGHT - 20))
+        screen.blit(self._coords_surfs[self.view_rotated], (0, 0))
     
     def get_board_position(self, mouse_x, mouse_y):
         """Convert mouse coordinates to board position, accounting for rotation"""
@@ -310,20 +829,21 @@ class ChessGame:
         return row, col
     
     def select_piece(self, row, col):
-        piece = self.board[row][col]
+        piece = self.board[row * 8 + col]
         if piece and piece.color == self.current_player:
             self.selected_piece = piece
-            self.valid_moves = self.get_valid_moves(piece)
+            valid_moves = self._legal_for_side.get(piece)
+            self.valid_moves = self.get_valid_moves(piece) if valid_moves is None else valid_moves
             return True
         return False
     def side_opponet_pawn(self,piece_):
-        # print(piece_.col,piece_.row,self.board[piece_.col-1][piece_.row])
+        # print(piece_.col,piece_.row,self.board[piece_.row*8+piece_.col-1])
         if piece_.col>0:
-            if(self.board[piece_.row][piece_.col-1]) != None:
+            if(self.board[piece_.row*8+piece_.col-1]) != None:
                 print("passant")
                 return True
         if piece_.col<7:
-            if (self.board[piece_.row][piece_.col+1]) != None and self.board[piece_.row][piece_.col+1].color!= piece_.color:
+            if (self.board[piece_.row*8+piece_.col+1]) != None and self.board[piece_.row*8+piece_.col+1].color!= piece_.color:
                 print("passant")
                 return True
         print("non passant")
@@ -333,89 +853,89 @@ class ChessGame:
         if not self.selected_piece:
             return False
         
-        if (to_row, to_col) not in self.valid_moves:
+        if not self.valid_moves & (1 << (to_row * 8 + to_col)):
             return False
         
         # Save state for undo and en passant tracking
         from_row, from_col = self.selected_piece.row, self.selected_piece.col
-        captured_piece = self.board[to_row][to_col]
+        captured_piece = self.board[to_row * 8 + to_col]
         
         # Handle en passant capture
         en_passant_capture = False
-        if (self.selected_piece.piece_type == 'pawn' and 
+        if (self.selected_piece.piece_type == PAWN and 
             self.en_passant_target and 
             to_row == self.en_passant_target[0] and 
             to_col == self.en_passant_target[1]):
             # Capture the pawn that moved two squares
             captured_pawn_row = from_row  # Same row as the moving pawn was
             captured_pawn_col = to_col    # Same column as the target
-            captured_piece = self.board[captured_pawn_row][captured_pawn_col]
-            self.board[captured_pawn_row][captured_pawn_col] = None
+            captured_piece = self._lift(captured_pawn_row, captured_pawn_col)
             en_passant_capture = True
         
         # Handle castling
         castling = False
-        if self.selected_piece.piece_type == 'king' and abs(to_col - from_col) == 2:
+        if self.selected_piece.piece_type == KING and abs(to_col - from_col) == 2:
             castling = True
-            # Determine which rook to move
-            if to_col > from_col:  # Kingside castling
-                rook_from_col = 7
-                rook_to_col = to_col - 1
-            else:  # Queenside castling
-                rook_from_col = 0
-                rook_to_col = to_col + 1
-            
             # Move the rook
-            rook = self.board[from_row][rook_from_col]
-            self.board[from_row][rook_from_col] = None
-            self.board[from_row][rook_to_col] = rook
-            rook.col = rook_to_col
+            rook_from_col, rook_to_col = CASTLING_ROOK_COLS[to_col > from_col]
+            rook = self._lift(from_row, rook_from_col)
             rook.has_moved = True
+            self._put(rook, from_row, rook_to_col)
         
         # Move the piece
-        self.board[from_row][from_col] = None
-        self.board[to_row][to_col] = self.selected_piece
-        self.selected_piece.row = to_row
-        self.selected_piece.col = to_col
+        self._lift(from_row, from_col)
+        self._lift(to_row, to_col)
+        if captured_piece:
+            self.pieces_by_color[captured_piece.color].remove(captured_piece)
         self.selected_piece.has_moved = True
+        self._put(self.selected_piece, to_row, to_col)
         
         # Handle pawn two-square move (set en passant target)
         
-        if (self.selected_piece.piece_type == 'pawn' and 
+        if (self.selected_piece.piece_type == PAWN and 
             abs(to_row - from_row) == 2 ):
             # Set en passant target to the square behind the pawn
             
-            self.en_passant_target = ((from_row + to_row) // 2, to_col)
+            self._set_en_passant_target(((from_row + to_row) // 2, to_col))
         else:
-            self.en_passant_target = None
+            self._set_en_passant_target(None)
         # Play sound
         if move_sound:
             move_sound.play()
         
         # Check for pawn promotion
-        if self.selected_piece.piece_type == 'pawn':
-            if (self.selected_piece.color == 'white' and to_row == 0) or \
-               (self.selected_piece.color == 'black' and to_row == 7):
+        promotion = None
+        if self.selected_piece.piece_type == PAWN:
+            if (self.selected_piece.color == WHITE_SIDE and to_row == 0) or \
+               (self.selected_piece.color == BLACK_SIDE and to_row == 7):
                 self.promote_pawn(self.selected_piece)
+                promotion = self.selected_piece.piece_type
         
         # Switch players
-        self.current_player = 'black' if self.current_player == 'white' else 'white'
+        self._switch_player()
         self.move_count += 1
-        if self.network_mode and self.player_side:
+        if self.network_mode and self.player_side is not None:
             self.is_my_turn = (self.player_side == self.current_player)
         # Check for check/checkmate
+        self._start_turn()
         self.check = self.is_in_check(self.current_player)
         if self.check:
             if self.is_checkmate(self.current_player):
                 self.checkmate = True
                 self.game_over = True
-                self.winner = 'black' if self.current_player == 'white' else 'white'
+                self.winner = self.current_player ^ 1
             elif self.is_stalemate(self.current_player):
                 self.stalemate = True
                 self.game_over = True
         elif self.is_stalemate(self.current_player):
             self.stalemate = True
             self.game_over = True
+        # Same pieces, side to move, castling and en passant rights for the third time
+        key = self._repetition_key()
+        self.position_counts[key] += 1
+        if self.position_counts[key] >= 3 and not self.game_over:
+            self.repetition = True
+            self.game_over = True
         
         # Save move to history
         self.move_history.append({
@@ -424,433 +944,399 @@ class ChessGame:
             'piece': self.selected_piece,
             'captured': captured_piece,
             'en_passant': en_passant_capture,
-            'castling': castling
+            'castling': castling,
+            'promotion': promotion
         })
         
         # Reset selection
         self.selected_piece = None
-        self.valid_moves = []
+        self.valid_moves = 0
         return True
     
-    def promote_pawn(self, pawn):
-        # For simplicity, always promote to queen
-        pawn.piece_type = 'queen'
+    def promote_pawn(self, pawn, piece_type=QUEEN):
+        # For simplicity, local moves always promote to queen
+        self._toggle(pawn, pawn.row, pawn.col)
+        pawn.piece_type = piece_type
+        self._toggle(pawn, pawn.row, pawn.col)
     
     def get_valid_moves(self, piece):
-        moves = []
+        # Moves only depend on the position, so serve repeat queries from the cache
+        zkey = self.zkey
+        position_moves = self._move_cache.get(zkey)
+        if position_moves is None:
+            position_moves = self._move_cache[zkey] = {}
+            if len(self._move_cache) > MOVE_CACHE_SIZE:
+                self._move_cache.popitem(last=False)
+        else:
+            self._move_cache.move_to_end(zkey)
         row, col = piece.row, piece.col
+        valid_moves = position_moves.get((row, col))
+        if valid_moves is not None:
+            return valid_moves
         
-        if piece.piece_type == 'pawn':
-            direction = -1 if piece.color == 'white' else 1
-            
-            # Move forward
-            if 0 <= row + direction < 8 and not self.board[row + direction][col]:
-                moves.append((row + direction, col))
-                
-                # Initial double move
-                if not piece.has_moved:
-                    if 0 <= row + 2 * direction < 8 and not self.board[row + 2 * direction][col]:
-                        moves.append((row + 2 * direction, col))
-            
-            # Capture diagonally (not horizontally or vertically)
-            for dc in [-1, 1]:
-                if 0 <= row + direction < 8 and 0 <= col + dc < 8:
-                    target = self.board[row + direction][col + dc]
-                    # Normal capture
-                    if target and target.color != piece.color:
-                        moves.append((row + direction, col + dc))
-                    # En passant capture
-                    elif (self.en_passant_target != None and 
-                          row + direction == self.en_passant_target[0] and 
-                          col + dc == self.en_passant_target[1]):
-                        moves.append((row + direction, col + dc))
-        
-        elif piece.piece_type == 'rook':
-            # Horizontal and vertical moves
-            for dr, dc in [(0, 1), (1, 0), (0, -1), (-1, 0)]:
-                for i in range(1, 8):
-                    r, c = row + i * dr, col + i * dc
-                    if not (0 <= r < 8 and 0 <= c < 8):
-                        break
-                    target = self.board[r][c]
-                    if not target:
-                        moves.append((r, c))
-                    elif target.color != piece.color:
-                        moves.append((r, c))
-                        break
-                    else:
-                        break
-        
-        elif piece.piece_type == 'knight':
-            # L-shaped moves
-            for dr, dc in [(2, 1), (1, 2), (-1, 2), (-2, 1), (-2, -1), (-1, -2), (1, -2), (2, -1)]:
-                r, c = row + dr, col + dc
-                if 0 <= r < 8 and 0 <= c < 8:
-                    target = self.board[r][c]
-                    if not target or target.color != piece.color:
-                        moves.append((r, c))
-        
-        elif piece.piece_type == 'bishop':
-            # Diagonal moves
-            for dr, dc in [(1, 1), (1, -1), (-1, 1), (-1, -1)]:
-                for i in range(1, 8):
-                    r, c = row + i * dr, col + i * dc
-                    if not (0 <= r < 8 and 0 <= c < 8):
-                        break
-                    target = self.board[r][c]
-                    if not target:
-                        moves.append((r, c))
-                    elif target.color != piece.color:
-                        moves.append((r, c))
-                        break
-                    else:
-                        break
-        
-        elif piece.piece_type == 'queen':
-            # Combination of rook and bishop moves
-            for dr, dc in [(0, 1), (1, 0), (0, -1), (-1, 0), (1, 1), (1, -1), (-1, 1), (-1, -1)]:
-                for i in range(1, 8):
-                    r, c = row + i * dr, col + i * dc
-                    if not (0 <= r < 8 and 0 <= c < 8):
-                        break
-                    target = self.board[r][c]
-                    if not target:
-                        moves.append((r, c))
-                    elif target.color != piece.color:
-                        moves.append((r, c))
-                        break
-                    else:
-                        break
-        
-        elif piece.piece_type == 'king':
-            # One square in any direction
-            for dr in [-1, 0, 1]:
-                for dc in [-1, 0, 1]:
-                    if dr == 0 and dc == 0:
-                        continue
-                    r, c = row + dr, col + dc
-                    if 0 <= r < 8 and 0 <= c < 8:
-                        target = self.board[r][c]
-                        if not target or target.color != piece.color:
-                            moves.append((r, c))
-            
-            # Castling
-            if not piece.has_moved and not self.is_in_check(piece.color):
-                # Kingside castling
-                if (self.board[row][7] and 
-                    self.board[row][7].piece_type == 'rook' and 
-                    not self.board[row][7].has_moved and
-                    not self.board[row][5] and 
-                    not self.board[row][6]):
-                    # Check if squares are not under attack
-                    if not self.is_square_attacked(row, 5, piece.color) and not self.is_square_attacked(row, 6, piece.color):
-                        moves.append((row, 6))  # Kingside castling
-                
-                # Queenside castling
-                if (self.board[row][0] and 
-                    self.board[row][0].piece_type == 'rook' and 
-                    not self.board[row][0].has_moved and
-                    not self.board[row][1] and 
-                    not self.board[row][2] and 
-                    not self.board[row][3]):
-                    # Check if squares are not under attack
-                    if not self.is_square_attacked(row, 3, piece.color) and not self.is_square_attacked(row, 2, piece.color):
-                        moves.append((row, 2))  # Queenside castling
+        moves = MOVEGEN[piece.piece_type](self, piece)
         
         # Filter out moves that would put/leave the king in check
-        valid_moves = []
-        for move in moves:
-            if not self.would_be_in_check(piece, move[0], move[1]):
-                valid_moves.append(move)
-        
+        if piece.piece_type == KING:
+            # Each king step has to be tested against the attackers on its own
+            valid_moves = 0
+            while moves:
+                bit = moves & -moves
+                moves ^= bit
+                to_row, to_col = divmod(bit.bit_length() - 1, 8)
+                if not self.would_be_in_check(piece, to_row, to_col):
+                    valid_moves |= bit
+        else:
+            # Other pieces are only held back by a check or a pin, and each of
+            # those is one mask over the whole move set
+            self._update_legality(piece.color)
+            en_passant = 0
+            if piece.piece_type == PAWN and self.en_passant_target:
+                target_row, target_col = self.en_passant_target
+                en_passant = moves & (1 << (target_row * 8 + target_col))
+                moves ^= en_passant
+            if self._check_mask is not None:
+                moves &= self._check_mask
+            pin = self._pins.get(piece)
+            if pin is not None:
+                moves &= RAYS[pin][self._king_sq]
+            # En passant takes two pieces off one rank at once, so play it out
+            if en_passant and not self._en_passant_exposes_king(piece, target_row, target_col):
+                moves |= en_passant
+            valid_moves = moves
+        
+        position_moves[(row, col)] = valid_moves
         return valid_moves
     
     def find_king(self, color):
-        for row in range(8):
-            for col in range(8):
-                piece = self.board[row][col]
-                if piece and piece.color == color and piece.piece_type == 'king':
-                    return (row, col)
-        return None
+        return self.king_pos[color]
     
     def is_in_check(self, color):
-        king_pos = self.find_king(color)
-        if not king_pos:
+        # Asked several times in a row after each move (check, checkmate, stalemate)
+        key = (self.zkey, color)
+        in_check = self._check_cache.get(key)
+        if in_check is None:
+            in_check = self._check_cache[key] = self._king_attacked(color)
+        return in_check
+    
+    def _king_attacked(self, color):
+        # Straight off the bitboards: the king's square against the attack patterns
+        king = self.bb[color * 6 + KING]
+        if not king:
             return False
         
-        king_row, king_col = king_pos
-        
-        # Check if any opponent piece can attack the king
-        opponent_color = 'black' if color == 'white' else 'white'
-        for row in range(8):
-            for col in range(8):
-                piece = self.board[row][col]
-                if piece and piece.color == opponent_color:
-                    # Temporarily get all moves (even invalid ones to check attacks)
-                    moves = self.get_all_attacking_moves(piece)
-                    if (king_row, king_col) in moves:
-                        return True
-        return False
+        return bool(self._attackers(king.bit_length() - 1, color, self.occ_all))
     
-    def is_square_attacked(self, row, col, color):
+    def is_square_attacked(self, row, col, color, occ=None):
         # Check if a square is attacked by any opponent piece
-        opponent_color = 'black' if color == 'white' else 'white'
-        for r in range(8):
-            for c in range(8):
-                piece = self.board[r][c]
-                if piece and piece.color == opponent_color:
-                    moves = self.get_all_attacking_moves(piece)
-                    if (row, col) in moves:
-                        return True
-        return False
+        return bool(self._attackers(row * 8 + col, color, self.occ_all if occ is None else occ))
+    
+    def _attackers(self, sq, color, occ):
+        # Bitboard of the opponent pieces attacking sq: look outwards from the
+        # square with each piece's attack pattern and see what it hits
+        base = (color ^ 1) * 6
+        bb = self.bb
+        queens = bb[base + QUEEN]
+        return (PAWN_ATTACKS[color][sq] & bb[base + PAWN] |
+                KNIGHT_ATTACKS[sq] & bb[base + KNIGHT] |
+                KING_ATTACKS[sq] & bb[base + KING] |
+                bishop_attacks(sq, occ) & (bb[base + BISHOP] | queens) |
+                rook_attacks(sq, occ) & (bb[base + ROOK] | queens))
+    
+    def _update_legality(self, color):
+        """Find the pieces checking and pinned against color's king in the current position"""
+        key = (self.zkey, color)
+        if self._legality_key == key:
+            return
+        self._legality_key = key
+        self._pins = {}
+        self._check_mask = None
+        king = self.bb[color * 6 + KING]
+        if not king:
+            return
+        king_sq = self._king_sq = king.bit_length() - 1
+        
+        # In check, other pieces may only capture the checker or block its ray
+        checkers = self._attackers(king_sq, color, self.occ_all)
+        if checkers & (checkers - 1):
+            self._check_mask = 0  # Double check: only the king can move
+        elif checkers:
+            self._check_mask = checkers | BETWEEN[king_sq][checkers.bit_length() - 1]
+        
+        # Slide outwards from the king: a friendly piece with an opponent slider
+        # of the matching kind right behind it is pinned to that ray
+        base = (color ^ 1) * 6
+        own = self.occ[color]
+        queens = self.bb[base + QUEEN]
+        straight = self.bb[base + ROOK] | queens
+        diagonal = self.bb[base + BISHOP] | queens
+        for (dr, dc), rays in RAYS.items():
+            blockers = rays[king_sq] & self.occ_all
+            if not blockers:
+                continue
+            increasing = dr * 8 + dc > 0
+            first = blockers & -blockers if increasing else 1 << (blockers.bit_length() - 1)
+            rest = blockers ^ first
+            if not (first & own and rest):
+                continue
+            second = rest & -rest if increasing else 1 << (rest.bit_length() - 1)
+            if second & (straight if dr == 0 or dc == 0 else diagonal):
+                self._pins[self.board[first.bit_length() - 1]] = (dr, dc)
     
     def get_all_attacking_moves(self, piece):
-        # Get all possible moves without checking for check, but pawns only attack diagonally
-        moves = []
-        row, col = piece.row, piece.col
-        
-        if piece.piece_type == 'pawn':
-            direction = -1 if piece.color == 'white' else 1
-            
-            # Pawns attack diagonally only
-            for dc in [-1, 1]:
-                r, c = row + direction, col + dc
-                if 0 <= r < 8 and 0 <= c < 8:
-                    moves.append((r, c))
-        
-        elif piece.piece_type == 'rook':
-            # Horizontal and vertical moves
-            for dr, dc in [(0, 1), (1, 0), (0, -1), (-1, 0)]:
-                for i in range(1, 8):
-                    r, c = row + i * dr, col + i * dc
-                    if not (0 <= r < 8 and 0 <= c < 8):
-                        break
-                    moves.append((r, c))
-                    if self.board[r][c]:
-                        break
-        
-        elif piece.piece_type == 'knight':
-            # L-shaped moves
-            for dr, dc in [(2, 1), (1, 2), (-1, 2), (-2, 1), (-2, -1), (-1, -2), (1, -2), (2, -1)]:
-                r, c = row + dr, col + dc
-                if 0 <= r < 8 and 0 <= c < 8:
-                    moves.append((r, c))
+        # Bitboard of the squares a piece attacks, whether or not it could legally
+        # move there; pawns only attack diagonally
+        sq = piece.row * 8 + piece.col
+        if piece.piece_type == PAWN:
+            return PAWN_ATTACKS[piece.color][sq]
+        elif piece.piece_type == KNIGHT:
+            return KNIGHT_ATTACKS[sq]
+        elif piece.piece_type == KING:
+            return KING_ATTACKS[sq]
+        elif piece.piece_type == ROOK:
+            return rook_attacks(sq, self.occ_all)
+        elif piece.piece_type == BISHOP:
+            return bishop_attacks(sq, self.occ_all)
+        return queen_attacks(sq, self.occ_all)
+    
+    def attacked_squares(self, color):
+        # Bitboard of every square attacked by color's opponent
+        attacks = 0
+        for piece in self.pieces_by_color[color ^ 1]:
+            attacks |= self.get_all_attacking_moves(piece)
+        return attacks
+    
+    def would_be_in_check(self, piece, to_row, to_col):
+        self._update_legality(piece.color)
         
-        elif piece.piece_type == 'bishop':
-            # Diagonal moves
-            for dr, dc in [(1, 1), (1, -1), (-1, 1), (-1, -1)]:
-                for i in range(1, 8):
-                    r, c = row + i * dr, col + i * dc
-                    if not (0 <= r < 8 and 0 <= c < 8):
-                        break
-                    moves.append((r, c))
-                    if self.board[r][c]:
-                        break
+        if piece.piece_type == KING:
+            # Take the king off the occupancy so it can't shelter behind itself
+            # when stepping back along a checking ray
+            occ = self.occ_all ^ (1 << (piece.row * 8 + piece.col))
+            return self.is_square_attacked(to_row, to_col, piece.color, occ)
         
-        elif piece.piece_type == 'queen':
-            # Combination of rook and bishop moves
-            for dr, dc in [(0, 1), (1, 0), (0, -1), (-1, 0), (1, 1), (1, -1), (-1, 1), (-1, -1)]:
-                for i in range(1, 8):
-                    r, c = row + i * dr, col + i * dc
-                    if not (0 <= r < 8 and 0 <= c < 8):
-                        break
-                    moves.append((r, c))
-                    if self.board[r][c]:
-                        break
+        if piece.piece_type == PAWN and to_col != piece.col and not self.board[to_row * 8 + to_col]:
+            # En passant takes two pieces off one rank at once, so play it out
+            return self._en_passant_exposes_king(piece, to_row, to_col)
         
-        elif piece.piece_type == 'king':
-            # One square in any direction
-            for dr in [-1, 0, 1]:
-                for dc in [-1, 0, 1]:
-                    if dr == 0 and dc == 0:
-                        continue
-                    r, c = row + dr, col + dc
-                    if 0 <= r < 8 and 0 <= c < 8:
-                        moves.append((r, c))
+        to_bit = 1 << (to_row * 8 + to_col)
+        if self._check_mask is not None and not self._check_mask & to_bit:
+            return True
         
-        return moves
+        # A pinned piece may only move along the ray between its king and the pinner
+        pin = self._pins.get(piece)
+        return pin is not None and not RAYS[pin][self._king_sq] & to_bit
     
-    def would_be_in_check(self, piece, to_row, to_col):
+    def _en_passant_exposes_king(self, pawn, to_row, to_col):
         # Temporarily make the move
-        from_row, from_col = piece.row, piece.col
-        captured_piece = self.board[to_row][to_col]
+        from_row, from_col = pawn.row, pawn.col
+        captured_pawn = self._lift(from_row, to_col)
         
-        self.board[from_row][from_col] = None
-        self.board[to_row][to_col] = piece
-        piece.row, piece.col = to_row, to_col
+        self._lift(from_row, from_col)
+        self._put(pawn, to_row, to_col)
         
-        # Check if king is in check
-        in_check = self.is_in_check(piece.color)
+        # Check if king is in check, bypassing the cache for this trial position
+        in_check = self._king_attacked(pawn.color)
         
         # Undo the move
-        self.board[from_row][from_col] = piece
-        self.board[to_row][to_col] = captured_piece
-        piece.row, piece.col = from_row, from_col
+        self._lift(to_row, to_col)
+        self._put(pawn, from_row, from_col)
+        self._put(captured_pawn, from_row, to_col)
         
         return in_check
     
+    def _legal_moves_exist(self, color):
+        # Stop at the first legal move, trying the pieces most likely to have one
+        # (above all the king when in check) before the rest
+        position_moves = self._move_cache.get(self.zkey, {})
+        board = self.board
+        base = color * 6
+        for piece_type in (KING, QUEEN, PAWN, KNIGHT, ROOK, BISHOP):
+            pieces = self.bb[base + piece_type]
+            while pieces:
+                bit = pieces & -pieces
+                pieces ^= bit
+                sq = bit.bit_length() - 1
+                piece = board[sq]
+                row, col = divmod(sq, 8)
+                valid_moves = position_moves.get((row, col))
+                if valid_moves is not None:
+                    if valid_moves:
+                        return True
+                    continue
+                moves = MOVEGEN[piece_type](self, piece)
+                while moves:
+                    bit = moves & -moves
+                    moves ^= bit
+                    to_row, to_col = divmod(bit.bit_length() - 1, 8)
+                    if not self.would_be_in_check(piece, to_row, to_col):
+                        return True
+        return False
+    
+    def _has_any_legal_move(self, color):
+        key = (self.zkey, color)
+        has_move = self._any_legal_cache.get(key)
+        if has_move is None:
+            has_move = self._legal_moves_exist(color)
+            self._any_legal_cache[key] = has_move
+            if len(self._any_legal_cache) > MOVE_CACHE_SIZE:
+                self._any_legal_cache.popitem(last=False)
+        return has_move
+    
     def is_checkmate(self, color):
-        if not self.is_in_check(color):
-            return False
-        
         # Check if any move can get out of check
-        for row in range(8):
-            for col in range(8):
-                piece = self.board[row][col]
-                if piece and piece.color == color:
-                    moves = self.get_valid_moves(piece)
-                    if moves:
-                        return False
-        return True
+        return self.is_in_check(color) and not self._has_any_legal_move(color)
     
     def is_stalemate(self, color):
-        if self.is_in_check(color):
-            return False
-        
         # Check if any move is possible
-        for row in range(8):
-            for col in range(8):
-                piece = self.board[row][col]
-                if piece and piece.color == color:
-                    moves = self.get_valid_moves(piece)
-                    if moves:
-                        return False
-        return True
+        return not self.is_in_check(color) and not self._has_any_legal_move(color)
     
     def reset(self):
+        # Hang up first; __init__ would otherwise just drop the running connection
+        self.close_connection()
         self.__init__()
     
     def start_server(self, port, side):
         try:
-            self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            self.server_socket.bind(('localhost', port))
-            self.server_socket.listen(1)
-            print(f"Server listening on port {port}")
-            self.connection, addr = self.server_socket.accept()
-            print(f"Connected to {addr}")
+            self.net = NetworkClient()
+            addr = self.net.serve('localhost', port)
+            log.info("Connected to %s", addr)
             self.network_mode = 'server'
             self.player_side = side
-            self.is_my_turn = (side == 'white')
-            self.view_rotated = (side == 'black')
+            self.is_my_turn = (side == WHITE_SIDE)
+            self._set_view_rotated(side == BLACK_SIDE)
             self.move_count = 0
             self.game_mode = 'playing'
             # Send player side to client
-            self.send_move({'type': 'side', 'side': 'black' if side == 'white' else 'white'})
-            # Start receiving moves in a separate thread
-            threading.Thread(target=self.receive_moves, daemon=True).start()
+            self.send_move({'type': 'side', 'side': side ^ 1})
         except Exception as e:
-            print(f"Server error: {e}")
+            log.warning("Server error: %s", e, exc_info=True)
+            self.close_connection()
     
     def connect_to_server(self, host, port):
         try:
-            self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.client_socket.connect((host, port))
-            print(f"Connected to server at {host}:{port}")
-            self.connection = self.client_socket
+            self.net = NetworkClient()
+            self.net.connect(host, port)
+            log.info("Connected to server at %s:%s", host, port)
             self.network_mode = 'client'
             self.move_count = 0
             # Wait for side assignment from server
             self.game_mode = 'playing'
-            # Start receiving moves in a separate thread
-            threading.Thread(target=self.receive_moves, daemon=True).start()
         except Exception as e:
-            print(f"Client error: {e}")
+            log.warning("Client error: %s", e, exc_info=True)
+            self.close_connection()
     
     def send_move(self, move_data):
-        if self.connection:
-            try:
-                message = json.dumps(move_data)
-                self.connection.sendall(message.encode())
-            except Exception as e:
-                print(f"Send error: {e}")
-                self.handle_connection_error()
-    
-    def receive_moves(self):
-        while self.game_mode == 'playing':
-            try:
-                if self.connection:
-                    data = self.connection.recv(1024)
-                    if not data:
-                        self.handle_connection_error()
-                        break
-                    move_data = json.loads(data.decode())
-                    if move_data.get('type') == 'side':
-                        self.player_side = move_data['side']
-                        self.is_my_turn = (self.player_side == 'white')
-                        self.view_rotated = (self.player_side == 'black')
-                    else:
-                        self.apply_remote_move(move_data)
-            except Exception as e:
-                print(f"Receive error: {e}")
-                self.handle_connection_error()
-                break
-            time.sleep(0.1)
+        if self.net:
+            self.net.send(move_data)
+    
+    def process_network_messages(self):
+        # Apply everything the network thread has received so far
+        while self.net and not self.net.incoming.empty():
+            self.handle_network_message(self.net.incoming.get())
+    
+    def handle_network_message(self, move_data):
+        if move_data.get('type') == 'side':
+            self.player_side = move_data['side']
+            self.is_my_turn = (self.player_side == WHITE_SIDE)
+            self._set_view_rotated(self.player_side == BLACK_SIDE)
+        elif self._is_legal_remote_move(move_data):
+            self.apply_remote_move(move_data)
+        else:
+            # The opponent's board no longer matches ours, so the game can't go on
+            log.warning("Illegal move from opponent: %s", move_data)
+            self.handle_connection_error()
+    
+    def _is_legal_remote_move(self, move_data):
+        # unpack_message only range-checks the packet; check the move against
+        # our own position before apply_remote_move trusts it
+        (from_row, from_col), (to_row, to_col) = move_data['from'], move_data['to']
+        piece = self.board[from_row * 8 + from_col]
+        if not piece or piece.color != self.current_player or piece.color == self.player_side:
+            return False
+        if not self.get_valid_moves(piece) & (1 << (to_row * 8 + to_col)):
+            return False
+        
+        # The flags have to describe the move the way move_piece played it
+        castling = piece.piece_type == KING and abs(to_col - from_col) == 2
+        en_passant = (piece.piece_type == PAWN and to_col != from_col and
+                      not self.board[to_row * 8 + to_col])
+        promotion = piece.piece_type == PAWN and to_row in (0, 7)
+        return (bool(move_data.get('castling')) == castling and
+                bool(move_data.get('en_passant')) == en_passant and
+                (move_data.get('promotion') is not None) == promotion)
     
     def handle_connection_error(self):
-        print("Connection lost")
+        log.warning("Connection lost")
         self.game_mode = 'menu'
-        if self.server_socket:
-            self.server_socket.close()
-            self.server_socket = None
-        if self.client_socket:
-            self.client_socket.close()
-            self.client_socket = None
-        if self.connection:
-            self.connection.close()
-            self.connection = None
+        self.close_connection()
+    
+    def close_connection(self):
+        if self.net:
+            self.net.close()
+            self.net = None
     
     def apply_remote_move(self, move_data):
         from_pos = move_data['from']
         to_pos = move_data['to']
         
         # Move the piece
-        piece = self.board[from_pos[0]][from_pos[1]]
-        self.board[from_pos[0]][from_pos[1]] = None
-        self.board[to_pos[0]][to_pos[1]] = piece
-        piece.row, piece.col = to_pos
+        piece = self._lift(from_pos[0], from_pos[1])
+        captured_piece = self._lift(to_pos[0], to_pos[1])
         piece.has_moved = True
+        self._put(piece, to_pos[0], to_pos[1])
         
         # Handle special moves
         if move_data.get('castling'):
             # Move the rook
-            if to_pos[1] > from_pos[1]:  # Kingside
-                rook = self.board[from_pos[0]][7]
-                self.board[from_pos[0]][7] = None
-                self.board[from_pos[0]][5] = rook
-                rook.col = 5
-                rook.has_moved = True
-            else:  # Queenside
-                rook = self.board[from_pos[0]][0]
-                self.board[from_pos[0]][0] = None
-                self.board[from_pos[0]][3] = rook
-                rook.col = 3
-                rook.has_moved = True
+            rook_from_col, rook_to_col = CASTLING_ROOK_COLS[to_pos[1] > from_pos[1]]
+            rook = self._lift(from_pos[0], rook_from_col)
+            rook.has_moved = True
+            self._put(rook, from_pos[0], rook_to_col)
         
         if move_data.get('en_passant'):
             # Remove captured pawn
             captured_pawn_row = from_pos[0]
             captured_pawn_col = to_pos[1]
-            self.board[captured_pawn_row][captured_pawn_col] = None
+            captured_piece = self._lift(captured_pawn_row, captured_pawn_col)
+        
+        if captured_piece:
+            self.pieces_by_color[captured_piece.color].remove(captured_piece)
+        
+        if move_data.get('promotion') is not None:
+            self.promote_pawn(piece, move_data['promotion'])
+        
+        # A two-square pawn move can be taken en passant on the next move only
+        if piece.piece_type == PAWN and abs(to_pos[0] - from_pos[0]) == 2:
+            self._set_en_passant_target(((from_pos[0] + to_pos[0]) // 2, to_pos[1]))
+        else:
+            self._set_en_passant_target(None)
         
         # Switch turns
-        self.current_player = 'black' if self.current_player == 'white' else 'white'
+        self._switch_player()
         self.move_count += 1
         self.is_my_turn = not self.is_my_turn
         
         # Check for check/checkmate
+        self._start_turn()
         self.check = self.is_in_check(self.current_player)
         if self.check:
             if self.is_checkmate(self.current_player):
                 self.checkmate = True
                 self.game_over = True
-                self.winner = 'black' if self.current_player == 'white' else 'white'
+                self.winner = self.current_player ^ 1
             elif self.is_stalemate(self.current_player):
                 self.stalemate = True
                 self.game_over = True
         elif self.is_stalemate(self.current_player):
             self.stalemate = True
             self.game_over = True
+        # Same pieces, side to move, castling and en passant rights for the third time
+        key = self._repetition_key()
+        self.position_counts[key] += 1
+        if self.position_counts[key] >= 3 and not self.game_over:
+            self.repetition = True
+            self.game_over = True
 
 # Create game instance
 game = ChessGame()
@@ -869,21 +1355,79 @@ back_button = Button(WIDTH//2 - 100, HEIGHT//2 + 160, 200, 50, "Back")
 white_side_button = Button(WIDTH//2 - 100, HEIGHT//2 - 50, 200, 50, "Play as White")
 black_side_button = Button(WIDTH//2 - 100, HEIGHT//2 + 20, 200, 50, "Play as Black")
 
+# Create buttons for online setup
+start_server_button = Button(WIDTH//2 - 100, HEIGHT//2 + 50, 200, 50, "Start Server")
+connect_button = Button(WIDTH//2 - 100, HEIGHT//2 + 80, 200, 50, "Connect")
+
+# Buttons shown on each screen
+MODE_BUTTONS = {
+    'menu': (local_button, online_button, quit_button),
+    'online_menu': (server_button, client_button, back_button),
+    'side_selection': (white_side_button, black_side_button),
+    'server_setup': (start_server_button,),
+    'client_setup': (connect_button,),
+}
+
 # Create input boxes for online setup
 port_input = InputBox(WIDTH//2 - 100, HEIGHT//2 - 30, 200, 40, "5555")
-host_input = InputBox(WIDTH//2 - 100, HEIGHT//2 - 30, 200, 40, "localhost")
+host_input = InputBox(WIDTH//2 - 100, HEIGHT//2 - 80, 200, 40, "localhost")
 
 # Main game loop
 clock = pygame.time.Clock()
 running = True
+needs_redraw = True
+
+# Held keys (backspace) repeat. Text input is only switched on while an input
+# box has focus, since on Android starting it brings up the on-screen keyboard.
+pygame.key.set_repeat(400, 40)
+pygame.key.stop_text_input()
+text_input_on = False
 
 while running:
+    # Sleep until something happens. On the network opponent's turn nothing can
+    # change until their move arrives, so block until then.
+    if game.game_mode == 'playing' and game.network_mode and not game.is_my_turn:
+        events = [pygame.event.wait()]
+    else:
+        events = [pygame.event.wait(16)]
+    events += pygame.event.get()
+    events = [event for event in events if event.type != pygame.NOEVENT]
+    # Mouse motion on its own can only change button hover states, which are
+    # redrawn below without repainting the whole screen
+    if any(event.type != pygame.MOUSEMOTION for event in events):
+        needs_redraw = True
+    
     mouse_pos = pygame.mouse.get_pos()
+    frame_mode = game.game_mode
+    changed_buttons = []
+    
+    # Input boxes on the current screen
+    if game.game_mode == 'server_setup':
+        active_inputs = (port_input,)
+    elif game.game_mode == 'client_setup':
+        active_inputs = (host_input, port_input)
+    else:
+        active_inputs = ()
     
     # Handle events
-    for event in pygame.event.get():
+    for event in events:
         if event.type == pygame.QUIT:
             running = False
+        elif event.type == NETWORK_MOVE_EVENT:
+            game.process_network_messages()
+        elif event.type == CONNECTION_LOST_EVENT:
+            game.handle_connection_error()
+        elif event.type == pygame.TEXTINPUT:
+            # Typed characters go to the focused box only, in order with backspaces
+            for box in active_inputs:
+                if box.active:
+                    box.apply_text(event.text)
+                    break
+        elif event.type == pygame.MOUSEMOTION:
+            # Hover only changes when the mouse moves
+            for button in MODE_BUTTONS.get(game.game_mode, ()):
+                if button.check_hover(event.pos):
+                    changed_buttons.append(button)
         elif event.type == pygame.KEYDOWN:
             if event.key == pygame.K_r and game.game_mode == 'playing':
                 game.reset()
@@ -893,48 +1437,49 @@ while running:
                     game.game_mode = 'online_menu'
                 else:
                     game.game_mode = 'online_menu'
+            else:
+                for box in active_inputs:
+                    box.handle_event(event)
         elif event.type == pygame.MOUSEBUTTONDOWN:
             if game.game_mode == 'menu':
-                if local_button.is_clicked(mouse_pos, event):
+                if local_button.is_clicked(event.pos, event):
                     game.game_mode = 'playing'
                     game.player_side = None
-                elif online_button.is_clicked(mouse_pos, event):
+                elif online_button.is_clicked(event.pos, event):
                     game.game_mode = 'online_menu'
-                elif quit_button.is_clicked(mouse_pos, event):
+                elif quit_button.is_clicked(event.pos, event):
                     running = False
             elif game.game_mode == 'online_menu':
-                if server_button.is_clicked(mouse_pos, event):
+                if server_button.is_clicked(event.pos, event):
                     game.game_mode = 'side_selection'
-                elif client_button.is_clicked(mouse_pos, event):
+                elif client_button.is_clicked(event.pos, event):
                     game.game_mode = 'client_setup'
-                elif back_button.is_clicked(mouse_pos, event):
+                elif back_button.is_clicked(event.pos, event):
                     game.game_mode = 'menu'
             elif game.game_mode == 'side_selection':
-                if white_side_button.is_clicked(mouse_pos, event):
+                if white_side_button.is_clicked(event.pos, event):
                     game.game_mode = 'server_setup'
-                    game.player_side = 'white'
-                elif black_side_button.is_clicked(mouse_pos, event):
+                    game.player_side = WHITE_SIDE
+                elif black_side_button.is_clicked(event.pos, event):
                     game.game_mode = 'server_setup'
-                    game.player_side = 'black'
+                    game.player_side = BLACK_SIDE
             elif game.game_mode == 'server_setup':
                 port_input.handle_event(event)
-                if event.type == pygame.MOUSEBUTTONDOWN:
-                    if WIDTH//2 - 100 <= mouse_pos[0] <= WIDTH//2 + 100 and HEIGHT//2 + 50 <= mouse_pos[1] <= HEIGHT//2 + 100:
-                        try:
-                            port = int(port_input.text)
-                            game.start_server(port, game.player_side)
-                        except ValueError:
-                            print("Invalid port number")
+                if start_server_button.is_clicked(event.pos, event):
+                    try:
+                        port = int(port_input.text)
+                        game.start_server(port, game.player_side)
+                    except ValueError:
+                        log.warning("Invalid port number: %r", port_input.text)
             elif game.game_mode == 'client_setup':
                 host_input.handle_event(event)
                 port_input.handle_event(event)
-                if event.type == pygame.MOUSEBUTTONDOWN:
-                    if WIDTH//2 - 100 <= mouse_pos[0] <= WIDTH//2 + 100 and HEIGHT//2 + 80 <= mouse_pos[1] <= HEIGHT//2 + 130:
-                        try:
-                            port = int(port_input.text)
-                            game.connect_to_server(host_input.text, port)
-                        except ValueError:
-                            print("Invalid port number")
+                if connect_button.is_clicked(event.pos, event):
+                    try:
+                        port = int(port_input.text)
+                        game.connect_to_server(host_input.text, port)
+                    except ValueError:
+                        log.warning("Invalid port number: %r", port_input.text)
             elif game.game_mode == 'playing':
                 if event.button == 1:  # Left mouse button
                     # Get board position accounting for rotation
@@ -942,7 +1487,7 @@ while running:
                     
                     if 0 <= row < 8 and 0 <= col < 8:
                         # If it's a human player's turn or local play
-                        if (game.player_side is None or 
+                        if not game.game_over and (game.player_side is None or 
                             (game.player_side == game.current_player and game.is_my_turn)):
                             if game.selected_piece:
                                 # Try to move the selected piece
@@ -952,179 +1497,177 @@ while running:
                                 else:
                                     # If move succeeded and in network mode, send move
                                     if game.network_mode:
+                                        last = game.move_history[-1]
                                         move_data = {
-                                            'from': (game.move_history[-1]['from'][0], game.move_history[-1]['from'][1]),
-                                            'to': (game.move_history[-1]['to'][0], game.move_history[-1]['to'][1]),
-                                            'castling': game.move_history[-1]['castling'],
-                                            'en_passant': game.move_history[-1]['en_passant']
+                                            'from': last['from'],
+                                            'to': last['to'],
+                                            'castling': last['castling'],
+                                            'en_passant': last['en_passant'],
+                                            'promotion': last['promotion']
                                         }
                                         game.send_move(move_data)
                             else:
                                 # Select a piece
                                 game.select_piece(row, col)
     
-    # Update button hover states
-    if game.game_mode == 'menu':
-        local_button.check_hover(mouse_pos)
-        online_button.check_hover(mouse_pos)
-        quit_button.check_hover(mouse_pos)
-    elif game.game_mode == 'online_menu':
-        server_button.check_hover(mouse_pos)
-        client_button.check_hover(mouse_pos)
-        back_button.check_hover(mouse_pos)
-    elif game.game_mode == 'side_selection':
-        white_side_button.check_hover(mouse_pos)
-        black_side_button.check_hover(mouse_pos)
-    elif game.game_mode == 'server_setup':
-        port_input.update()
-    elif game.game_mode == 'client_setup':
-        host_input.update()
-        port_input.update()
+    # Text input (the on-screen keyboard on Android) only while a box has focus
+    typing = any(box.active for box in active_inputs)
+    if typing != text_input_on:
+        if typing:
+            pygame.key.start_text_input()
+        else:
+            pygame.key.stop_text_input()
+        text_input_on = typing
     
-    # Draw everything
-    screen.fill((50, 50, 50))  # Background
+    # A new screen may have put a button under the pointer without it moving
+    if game.game_mode != frame_mode:
+        for button in MODE_BUTTONS.get(game.game_mode, ()):
+            button.check_hover(mouse_pos)
     
-    if game.game_mode == 'menu':
-        # Draw title
-        title = title_font.render("Chess Game", True, WHITE)
-        screen.blit(title, (WIDTH//2 - title.get_width()//2, 100))
-        
-        # Draw buttons
-        local_button.draw(screen)
-        online_button.draw(screen)
-        quit_button.draw(screen)
-        
-        # Draw instructions
-        instructions = small_font.render("Choose your game mode", True, WHITE)
-        screen.blit(instructions, (WIDTH//2 - instructions.get_width()//2, HEIGHT - 50))
-    elif game.game_mode == 'online_menu':
-        # Draw title
-        title = title_font.render("Online Play", True, WHITE)
-        screen.blit(title, (WIDTH//2 - title.get_width()//2, 100))
-        
-        # Draw buttons
-        server_button.draw(screen)
-        client_button.draw(screen)
-        back_button.draw(screen)
-    elif game.game_mode == 'side_selection':
-        # Draw title
-        title = title_font.render("Choose Your Side", True, WHITE)
-        screen.blit(title, (WIDTH//2 - title.get_width()//2, 100))
-        
-        # Draw buttons
-        white_side_button.draw(screen)
-        black_side_button.draw(screen)
-        
-        # Draw back instruction
-        back_text = small_font.render("Press ESC to go back", True, WHITE)
-        screen.blit(back_text, (WIDTH//2 - back_text.get_width()//2, HEIGHT - 50))
-    elif game.game_mode == 'server_setup':
-        # Draw title
-        title = title_font.render("Host Game", True, WHITE)
-        screen.blit(title, (WIDTH//2 - title.get_width()//2, 100))
-        
-        # Draw instructions
-        instructions = font.render("Enter port number:", True, WHITE)
-        screen.blit(instructions, (WIDTH//2 - instructions.get_width()//2, HEIGHT//2 - 100))
-        
-        # Draw input box
-        port_input.draw(screen)
-        
-        # Draw start button
-        pygame.draw.rect(screen, BUTTON_COLOR, (WIDTH//2 - 100, HEIGHT//2 + 50, 200, 50), border_radius=10)
-        pygame.draw.rect(screen, WHITE, (WIDTH//2 - 100, HEIGHT//2 + 50, 200, 50), 2, border_radius=10)
-        start_text = font.render("Start Server", True, WHITE)
-        screen.blit(start_text, (WIDTH//2 - start_text.get_width()//2, HEIGHT//2 + 60))
-        
-        # Draw back instruction
-        back_text = small_font.render("Press ESC to go back", True, WHITE)
-        screen.blit(back_text, (WIDTH//2 - back_text.get_width()//2, HEIGHT - 50))
-    elif game.game_mode == 'client_setup':
-        # Draw title
-        title = title_font.render("Join Game", True, WHITE)
-        screen.blit(title, (WIDTH//2 - title.get_width()//2, 50))
-        
-        # Draw host instructions
-        host_label = font.render("Host IP:", True, WHITE)
-        screen.blit(host_label, (WIDTH//2 - host_label.get_width()//2, HEIGHT//2 - 120))
-        host_input.draw(screen)
-        
-        # Draw port instructions
-        port_label = font.render("Port:", True, WHITE)
-        screen.blit(port_label, (WIDTH//2 - port_label.get_width()//2, HEIGHT//2 - 30))
-        port_input.draw(screen)
-        
-        # Draw connect button
-        pygame.draw.rect(screen, BUTTON_COLOR, (WIDTH//2 - 100, HEIGHT//2 + 80, 200, 50), border_radius=10)
-        pygame.draw.rect(screen, WHITE, (WIDTH//2 - 100, HEIGHT//2 + 80, 200, 50), 2, border_radius=10)
-        connect_text = font.render("Connect", True, WHITE)
-        screen.blit(connect_text, (WIDTH//2 - connect_text.get_width()//2, HEIGHT//2 + 90))
-        
-        # Draw back instruction
-        back_text = small_font.render("Press ESC to go back", True, WHITE)
-        screen.blit(back_text, (WIDTH//2 - back_text.get_width()//2, HEIGHT - 50))
-    elif game.game_mode == 'playing':
-        game.draw_board(screen)
-        
-        # Draw game status
-        status_text = ""
-        if game.game_over:
-            if game.checkmate:
-                winner = "White" if game.winner == 'white' else "Black"
-                status_text = f"Checkmate! {winner} wins!"
-            elif game.stalemate:
-                status_text = "Stalemate! It's a draw."
-        elif game.check:
-            player = "White" if game.current_player == 'white' else "Black"
-            status_text = f"{player} is in check!"
-        else:
-            player = "White" if game.current_player == 'white' else "Black"
-            if game.player_side:
-                if game.network_mode:
-                    if game.is_my_turn:
-                        status_text = f"Your turn ({player})"
+    # Only redraw when an event may have changed what's on screen
+    if needs_redraw:
+        # Draw everything
+        screen.fill((50, 50, 50))  # Background
+        
+        if game.game_mode == 'menu':
+            # Draw title
+            title = _render_text(title_font, "Chess Game", WHITE)
+            screen.blit(title, (WIDTH//2 - title.get_width()//2, 100))
+            
+            # Draw buttons
+            local_button.draw(screen)
+            online_button.draw(screen)
+            quit_button.draw(screen)
+            
+            # Draw instructions
+            instructions = _render_text(small_font, "Choose your game mode", WHITE)
+            screen.blit(instructions, (WIDTH//2 - instructions.get_width()//2, HEIGHT - 50))
+        elif game.game_mode == 'online_menu':
+            # Draw title
+            title = _render_text(title_font, "Online Play", WHITE)
+            screen.blit(title, (WIDTH//2 - title.get_width()//2, 100))
+            
+            # Draw buttons
+            server_button.draw(screen)
+            client_button.draw(screen)
+            back_button.draw(screen)
+        elif game.game_mode == 'side_selection':
+            # Draw title
+            title = _render_text(title_font, "Choose Your Side", WHITE)
+            screen.blit(title, (WIDTH//2 - title.get_width()//2, 100))
+            
+            # Draw buttons
+            white_side_button.draw(screen)
+            black_side_button.draw(screen)
+            
+            # Draw back instruction
+            back_text = _render_text(small_font, "Press ESC to go back", WHITE)
+            screen.blit(back_text, (WIDTH//2 - back_text.get_width()//2, HEIGHT - 50))
+        elif game.game_mode == 'server_setup':
+            # Draw title
+            title = _render_text(title_font, "Host Game", WHITE)
+            screen.blit(title, (WIDTH//2 - title.get_width()//2, 100))
+            
+            # Draw instructions
+            instructions = _render_text(font, "Enter port number:", WHITE)
+            screen.blit(instructions, (WIDTH//2 - instructions.get_width()//2, HEIGHT//2 - 100))
+            
+            # Draw input box
+            port_input.draw(screen)
+            
+            # Draw start button
+            start_server_button.draw(screen)
+            
+            # Draw back instruction
+            back_text = _render_text(small_font, "Press ESC to go back", WHITE)
+            screen.blit(back_text, (WIDTH//2 - back_text.get_width()//2, HEIGHT - 50))
+        elif game.game_mode == 'client_setup':
+            # Draw title
+            title = _render_text(title_font, "Join Game", WHITE)
+            screen.blit(title, (WIDTH//2 - title.get_width()//2, 50))
+            
+            # Draw host instructions
+            host_label = _render_text(font, "Host IP:", WHITE)
+            screen.blit(host_label, (WIDTH//2 - host_label.get_width()//2, HEIGHT//2 - 120))
+            host_input.draw(screen)
+            
+            # Draw port instructions
+            port_label = _render_text(font, "Port:", WHITE)
+            screen.blit(port_label, (WIDTH//2 - port_label.get_width()//2, HEIGHT//2 - 30))
+            port_input.draw(screen)
+            
+            # Draw connect button
+            connect_button.draw(screen)
+            
+            # Draw back instruction
+            back_text = _render_text(small_font, "Press ESC to go back", WHITE)
+            screen.blit(back_text, (WIDTH//2 - back_text.get_width()//2, HEIGHT - 50))
+        elif game.game_mode == 'playing':
+            game.draw_board(screen)
+            
+            # Draw game status
+            status_text = ""
+            if game.game_over:
+                if game.checkmate:
+                    winner = SIDE_NAMES[game.winner].capitalize()
+                    status_text = f"Checkmate! {winner} wins!"
+                elif game.stalemate:
+                    status_text = "Stalemate! It's a draw."
+                elif game.repetition:
+                    status_text = "Threefold repetition! It's a draw."
+            elif game.check:
+                player = SIDE_NAMES[game.current_player].capitalize()
+                status_text = f"{player} is in check!"
+            else:
+                player = SIDE_NAMES[game.current_player].capitalize()
+                if game.player_side is not None:
+                    if game.network_mode:
+                        if game.is_my_turn:
+                            status_text = f"Your turn ({player})"
+                        else:
+                            status_text = f"Opponent's turn ({player})"
                     else:
-                        status_text = f"Opponent's turn ({player})"
+                        if game.player_side == game.current_player:
+                            status_text = f"Your turn ({player})"
+                        else:
+                            status_text = f"Opponent's turn ({player})"
                 else:
-                    if game.player_side == game.current_player:
-                        status_text = f"Your turn ({player})"
-                    else:
-                        status_text = f"Opponent's turn ({player})"
-            else:
-                status_text = f"{player}'s turn"
-        
-        text = font.render(status_text, True, WHITE)
-        screen.blit(text, (WIDTH // 2 - text.get_width() // 2, 10))
-        
-        # Draw move count for debugging
-        move_count_text = small_font.render(f"Move: {game.move_count}", True, WHITE)
-        screen.blit(move_count_text, (10, 10))
-        
-        # Draw instructions
-        if game.network_mode:
-            if game.is_my_turn:
-                instructions = small_font.render("Your turn - click to select/move pieces", True, WHITE)
+                    status_text = f"{player}'s turn"
+            
+            text = _render_text(font, status_text, WHITE)
+            screen.blit(text, (WIDTH // 2 - text.get_width() // 2, 10))
+            
+            # Draw move count for debugging
+            move_count_text = _render_text(small_font, f"Move: {game.move_count}", WHITE)
+            screen.blit(move_count_text, (10, 10))
+            
+            # Draw instructions
+            if game.network_mode:
+                if game.is_my_turn:
+                    instructions = _render_text(small_font, "Your turn - click to select/move pieces", WHITE)
+                else:
+                    instructions = _render_text(small_font, "Waiting for opponent...", WHITE)
+            elif game.player_side is not None:
+                instructions = _render_text(small_font, "You are playing as " + SIDE_NAMES[game.player_side].capitalize(), WHITE)
             else:
-                instructions = small_font.render("Waiting for opponent...", True, WHITE)
-        elif game.player_side:
-            instructions = small_font.render("You are playing as " + game.player_side.capitalize(), True, WHITE)
-        else:
-            instructions = small_font.render("Local play - click to select/move pieces", True, WHITE)
-        screen.blit(instructions, (WIDTH // 2 - instructions.get_width() // 2, HEIGHT - 30))
-    
-    # Update display
-    pygame.display.flip()
+                instructions = _render_text(small_font, "Local play - click to select/move pieces", WHITE)
+            screen.blit(instructions, (WIDTH // 2 - instructions.get_width() // 2, HEIGHT - 30))
+        
+        # Update display
+        pygame.display.flip()
+        needs_redraw = False
+    elif changed_buttons:
+        # Just the buttons the mouse moved onto or off
+        for button in changed_buttons:
+            button.draw(screen)
+        pygame.display.update([button.rect for button in changed_buttons])
     
-    # Cap the frame rate
-    clock.tick(60)
+    # Cap the frame rate; nothing animates outside the board, and input
+    # queued between frames on the menus is still handled in order
+    clock.tick(60 if game.game_mode == 'playing' else 10)
 
-# Clean up sockets
-if game.server_socket:
-    game.server_socket.close()
-if game.client_socket:
-    game.client_socket.close()
-if game.connection:
-    game.connection.close()
+# Clean up the connection
+game.close_connection()
 
 # Quit pygame
 pygame.quit()